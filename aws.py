@@ -1,21 +1,17 @@
-import os
+import socket
 import sys
 import time
 from datetime import datetime
 from signal import signal, SIGINT
-from subprocess import call
 from sys import exit
 from typing import List, Optional, Dict, Tuple
 
-import boto3
 import click
 import paramiko
 from paramiko import SSHException
-from paramiko.ssh_exception import NoValidConnectionsError
-from prettytable import PrettyTable
 
 from aws_config import loadconfig, Params
-from aws_utils import _get_instance_by_name, _collect_instances, _get_tag_val
+from aws_utils import _get_instance_by_name, _collect_instances, _get_tag_val, _ec2
 from launch import (
     upload_and_run,
     start,
@@ -23,7 +19,11 @@ from launch import (
     make_parallel_commands,
     cleanup_instance, _compress_folder, _random_name,
 )
-from machine_monitor import MachineMonitor
+from machine_monitor import MachineMonitor, GpuStat
+from ssh_utils import ShellSession, connect_client
+
+# how often (seconds) the monitor refreshes the list of running machines
+EC2_REFRESH_PERIOD = 5
 
 
 @click.group()
@@ -44,7 +44,7 @@ def kill(name: str, owner: Optional[str]):
         print(f"Could not find instance called {name}")
         return
 
-    client = boto3.client("ec2", region_name=config.region)
+    client = _ec2(config.region)
     response = client.terminate_instances(InstanceIds=[instance["InstanceId"]])
     print(f"Terminate response: {response}")
     print(f"\n Instance terminated")
@@ -60,9 +60,6 @@ def monitor(owner: Optional[str], sleep: float, debug: bool):
     if owner is not None:
         config.owner = owner
 
-    def clear_console():
-        _ = call("clear" if os.name == "posix" else "cls", shell=True)
-
     def handler(signal_received, frame):
         # https://www.devdungeon.com/content/python-catch-sigint-ctrl-c
         print(
@@ -72,7 +69,7 @@ def monitor(owner: Optional[str], sleep: float, debug: bool):
 
         # join the threads and exit
         for name, thread in threads.items():
-            thread.comm["should_stop"] = True
+            thread.stop()
         for name, thread in threads.items():
             if thread.is_alive():
                 thread.join()
@@ -82,94 +79,126 @@ def monitor(owner: Optional[str], sleep: float, debug: bool):
         print(f"\nAll threads ended, exiting, bye\n")
         exit(0)
 
-    def get_machines(config: Params) -> Dict[str, str]:
+    def get_instances_by_name(config: Params) -> Dict[str, Dict]:
         instances = _collect_instances(config)
-        machines = {
-            _get_tag_val(ins["Tags"], "Name"): ins["PrivateIpAddress"]
-            for ins in instances
-        }
-        return machines
-
-    def _all_gpus_same_memory(received: List[Dict[str, str]]) -> bool:
-        first_mem = received[0]["total_mem"]
-        for rec in received:
-            if first_mem != rec["total_mem"]:
-                return False
-        return True
-
-    def make_gpu_fields(received: List[Dict[str, str]]) -> Tuple[str, str]:
+        return {_get_tag_val(ins["Tags"], "Name"): ins for ins in instances}
+
+    def make_gpu_fields(received: List[GpuStat]) -> Tuple[str, str]:
+        # no GPUs reported (e.g. no nvidia-smi on the machine)
+        if len(received) == 0:
+            return "-", "-"
+
         loads = []
-        mems = []
-        all_same = _all_gpus_same_memory(received)
+        used_mems = []
+        total_mems = []
+        first_mem = received[0].total_mem
+        all_same = True
 
         for gpu in received:
-            loads.append(gpu["util"])
-            if all_same:
-                mems.append(gpu["used_mem"])
-            else:
-                mems.append(gpu["used_mem"] + " /" + gpu["total_mem"] + "G")
+            total_mem = gpu.total_mem
+            loads.append(gpu.util)
+            used_mems.append(gpu.used_mem)
+            total_mems.append(total_mem)
+            all_same = all_same and total_mem == first_mem
 
         # if all memories are the same, append total memory at the end
-        memory = ",".join(mems)
         if all_same:
-            memory += " /" + received[0]["total_mem"] + "G"
+            memory = ",".join(used_mems) + " /" + first_mem + "G"
+        else:
+            memory = ",".join(
+                used + " /" + total + "G" for used, total in zip(used_mems, total_mems)
+            )
 
         return ",".join(loads), memory
 
+    def format_row(name, ip, load, gpu_utils, gpu_mems, exp_id, last_line) -> str:
+        return (
+            f"{name:<20}{ip:<16}{load:>6}  {gpu_utils:<24}{gpu_mems:<32}"
+            f"{exp_id:<8}{last_line}"
+        )
+
+    def make_rows(
+        name: str, ip: str, load: str, gpu: List[GpuStat], last_lines: List
+    ) -> List[str]:
+        gpu_utils, gpu_mems = make_gpu_fields(gpu)
+        if len(last_lines) == 0:
+            return [
+                format_row(
+                    name, ip, load, gpu_utils, gpu_mems, "-", "WARNING: NO LINE READ"
+                )
+            ]
+        rows = []
+        for line_id, (exp_id, last_line) in enumerate(last_lines):
+            if line_id == 0:
+                rows.append(
+                    format_row(name, ip, load, gpu_utils, gpu_mems, exp_id, last_line)
+                )
+            else:
+                rows.append(format_row("", "", "", "", "", exp_id, last_line))
+        return rows
+
     # Tell Python to run the handler() function when SIGINT is recieved
     signal(SIGINT, handler)
 
     threads: Dict[str, MachineMonitor] = {}
+    machines: Dict[str, str] = {}
+    last_ec2_refresh = 0.0
+    # name => (load, gpu, result, rows), the rows are rebuilt only if the comm changed
+    rendered: Dict[str, Tuple[str, List, Tuple, List[str]]] = {}
+    header = format_row("Name", "Ip", "Load", "GPU", "GPU mem", "EXPID", "stdout")
 
     while True:
-        # go through the machines, launch new monitors
-        machines = get_machines(config)
-        for name, ip in machines.items():
-            if not name in threads:
-                threads[name] = MachineMonitor(name, sleep, config)
-                threads[name].start()
-        # go through existing monitors, delete the old ones (note monitors end themselves)
-        to_remove = []
-        for name, _ in threads.items():
-            if name not in machines:
-                to_remove.append(name)
-        for remove in to_remove:
-            threads.pop(remove)
-
-        t = PrettyTable()
-        t.field_names = [
-            "Name",
-            "Ip",
-            "Load",
-            "GPU",
-            "GPU mem",
-            "EXPID",
-            "stdout",
-        ]  # "Heartbeat"
+        # the list of machines changes rarely, do not query the EC2 every tick
+        if time.time() - last_ec2_refresh > EC2_REFRESH_PERIOD:
+            last_ec2_refresh = time.time()
+            # one EC2 query for all the monitors
+            instances_by_name = get_instances_by_name(config)
+            machines = {
+                name: ins["PrivateIpAddress"] for name, ins in instances_by_name.items()
+            }
+            # go through the machines, launch new monitors
+            for name, ip in machines.items():
+                if not name in threads:
+                    threads[name] = MachineMonitor(name, sleep, config, instances_by_name)
+                    threads[name].start()
+                else:
+                    # the monitors only read it, swapping the reference is thread safe
+                    threads[name].instances = instances_by_name
+            # go through existing monitors, stop and delete the old ones
+            to_remove = []
+            for name, _ in threads.items():
+                if name not in machines:
+                    to_remove.append(name)
+            for remove in to_remove:
+                # the monitor would not notice, it keeps the old dict with its instance
+                threads[remove].stop()
+                threads.pop(remove)
+                rendered.pop(remove, None)
+
+        rows = [header]
         for name, ip in machines.items():
             comm = threads[name].comm
-            load = comm["load"]
-            gpu_utils, gpu_mems = make_gpu_fields(comm["gpu"])
-            last_lines, heartbeat = comm["result"]
-            if len(last_lines) == 0:
-                t.add_row(
-                    [name, ip, load, gpu_utils, gpu_mems, "-", "WARNING: NO LINE READ"]
-                )
-            else:
-                for line_id, (exp_id, last_line) in enumerate(last_lines):
-                    if line_id == 0:
-                        t.add_row(
-                            [name, ip, load, gpu_utils, gpu_mems, exp_id, last_line]
-                        )
-                    else:
-                        t.add_row(["", "", "", "", "", exp_id, last_line])
-
-        t.align = "l"
-
+            load, gpu, result = comm.load, comm.gpu, comm.result
+            # the monitor replaces the values on each update, identity check is enough
+            cached = rendered.get(name)
+            if (
+                cached is None
+                or cached[0] != load
+                or cached[1] is not gpu
+                or cached[2] is not result
+            ):
+                last_lines, heartbeat = result
+                cached = (load, gpu, result, make_rows(name, ip, load, gpu, last_lines))
+                rendered[name] = cached
+            rows.extend(cached[3])
+
+        # single write, cursor home and clear the screen instead of calling the 'clear'
+        output = f"Found {len(machines)} machines owned by {config.owner}:\n\n"
+        output += "\n".join(rows) + "\n"
         if not debug:
-            clear_console()
-        print(f"Found {len(machines)} machines owned by {config.owner}:\n")
-        print(t)
+            output = "\033[H\033[2J" + output
+        sys.stdout.write(output)
+        sys.stdout.flush()
         time.sleep(sleep)
 
 
@@ -220,12 +249,13 @@ def lastline(
 
     file = "setup.log" if setup else f"experiment_{group}.log"
 
+    shell = None
     try:
-        client.connect(hostname=instance_ip, username="ubuntu", pkey=key)
+        connect_client(client, instance_ip, key, bastion_host=config.bastion_host)
         print(f"DONE, connected")
+        shell = ShellSession(client)
         while True:
-            stdin, stdout, stderr = client.exec_command(f"tail -n 2 {file}")
-            read_bytes = stdout.read()
+            read_bytes = shell.run(f"tail -n 2 {file}")
             last_line = MachineMonitor.extract_last_line(read_bytes)
             print(last_line)
             if not debug:
@@ -233,8 +263,13 @@ def lastline(
 
             time.sleep(sleep)
 
-    except SSHException or NoValidConnectionsError:
+    except (SSHException, socket.error):
         print(f"Could not connect to: {name} with IP {instance_ip}")
+    finally:
+        # also on CTRL-C
+        if shell is not None:
+            shell.close()
+        client.close()
 
 
 @cli.command()
@@ -258,18 +293,43 @@ def tail(name: str, setup: bool, owner: Optional[str], group: int):
         return
     instance_ip = instance["PrivateIpAddress"]
     print(f"Connecting to {name} with IP: {instance_ip}")
+
+    # prepare the connection
+    key = paramiko.RSAKey.from_private_key_file(config.pem_file)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
     file = "setup.log" if setup else f"experiment_{group}.log"
 
-    command = " ".join(
-        [
-            "ssh",
-            f"-i {config.pem_file} " "ubuntu@" + instance_ip,
-            f"'tail -f -n 2000 {file} && exec bash -l'",
-        ]
-    )
-    print(command)
-    os.system(command)
-    return
+    def handler(signal_received, frame):
+        client.close()
+        print(f"\n\nSIGINT or CTRL-C detected, connection closed, bye\n")
+        exit(0)
+
+    signal(SIGINT, handler)
+
+    try:
+        connect_client(client, instance_ip, key, bastion_host=config.bastion_host)
+        print(f"DONE, connected")
+        stdin, stdout, stderr = client.exec_command(f"tail -f -n 2000 {file}")
+        # raw chunks, tqdm progress is updated by \r and might not end with a newline
+        sys.stdout.flush()  # the buffered text goes first, the chunks bypass it
+        while True:
+            data = stdout.channel.recv(32768)
+            if len(data) == 0:
+                break
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            error = stderr.read().decode("utf-8", "replace").strip()
+            print(error if error else f"Could not tail {file}, exit status: {exit_status}")
+
+    except (SSHException, socket.error):
+        print(f"Could not connect to: {name} with IP {instance_ip}")
+    finally:
+        client.close()
 
 
 @cli.command()
@@ -343,7 +403,7 @@ def makeimage(name: str):
 
     date_time = datetime.utcnow().strftime("%Y-%m-%d--%H-%M")
     image_name = f"i-{config.repo_name}-{date_time}"
-    client = boto3.client("ec2", region_name=config.region)
+    client = _ec2(config.region)
     result = client.create_image(InstanceId=instance["InstanceId"], Name=image_name)
     print(f"result: {result}")
     image_id = result["ImageId"]
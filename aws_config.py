@@ -1,64 +1,65 @@
+import functools
 import os
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from os.path import expanduser
 from typing import List, Dict, Any
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 CONFIG_LOC = "~/.aws_config.yaml"
 
 
 @dataclass
 class Params:
     # access
-    pem_file = "~/.ssh/key.pem"
+    pem_file: str = "~/.ssh/key.pem"
 
     # machines
-    instance_type = "p2.xlarge"   # e.g. "p2.xlarge"
-    ami_id = "FILL_IN"            # e.g. "ami-123456"
-    security_group = "FILL_IN"    # e.g. "sg-123abc"
-    region = "us-east-1"          # e.g. "us-east-1"
+    instance_type: str = "p2.xlarge"   # e.g. "p2.xlarge"
+    ami_id: str = "FILL_IN"            # e.g. "ami-123456"
+    security_group: str = "FILL_IN"    # e.g. "sg-123abc"
+    region: str = "us-east-1"          # e.g. "us-east-1"
+    bastion_host: str = ""             # e.g. "ubuntu@1.2.3.4", empty: connect directly
 
     # filtering & other
-    owner = "AUTO_DETECT"         # detected automatically
-    repo_name = "AUTO_DETECT"
-    group = "MY_GROUP"            # optionally setup by user
+    owner: str = "AUTO_DETECT"         # detected automatically
+    repo_name: str = "AUTO_DETECT"
+    group: str = "MY_GROUP"            # optionally setup by user
+
+
+_FIELD_NAMES = frozenset(field.name for field in fields(Params))
 
 
 def _get_members(params: Params) -> List[str]:
-    """ Get members of the Params dataclass (with default values)
-    https://stackoverflow.com/questions/1398022/looping-over-all-member-variables-of-a-class-in-python
-    """
-    members = [
-        attr
-        for attr in dir(params)
-        if not callable(getattr(params, attr)) and not attr.startswith("__")
-    ]
-    return members
+    """ Get members of the Params dataclass (with default values)"""
+    return [field.name for field in fields(params)]
 
 
 def from_dict(dictionary: Dict[str, Any]) -> Params:
     params = Params()
     for key, val in dictionary.items():
-        if not hasattr(params, key):
+        if key not in _FIELD_NAMES:
             raise Exception(f"Invalid contents of the yaml file! key: {key}")
         params.__setattr__(key, val)
     return params
 
 
 def to_dict(params: Params) -> Dict[str, Any]:
-    result = {}
-    # https://stackoverflow.com/questions/1398022/looping-over-all-member-variables-of-a-class-in-python
-    members = [
-        attr
-        for attr in dir(params)
-        if not callable(getattr(params, attr)) and not attr.startswith("__")
-    ]
+    return {field.name: getattr(params, field.name) for field in fields(params)}
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config_cached(path: str, mtime: float) -> Dict[str, Any]:
+    """Parse the yaml, cached by the modification time so that edits are picked up"""
 
-    for member in members:
-        result[member] = getattr(params, member)
-    return result
+    with open(path, "r") as file:
+        return yaml.load(file, Loader=_Loader)
 
 
 def loadconfig() -> Params:
@@ -80,8 +81,8 @@ def loadconfig() -> Params:
             yaml.dump(to_dict(def_params), file)
         time.sleep(15)
 
-    with open(config_name, "r") as file:
-        config = from_dict(yaml.load(file, Loader=yaml.FullLoader))
+    # new Params each call, callers modify it
+    config = from_dict(_load_config_cached(config_name, os.path.getmtime(config_name)))
 
     # potentially sanitize the home dir
     config.pem_file = config.pem_file.replace("~", expanduser("~"))
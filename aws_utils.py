@@ -1,4 +1,5 @@
-from typing import List, Dict
+import threading
+from typing import List, Dict, Any, Optional
 
 import boto3
 import click
@@ -11,10 +12,25 @@ def cli():
     pass
 
 
+# region => boto3 ec2 client, the construction is expensive (loads the service model)
+_EC2_CLIENTS: Dict[str, Any] = {}
+_EC2_CLIENTS_LOCK = threading.Lock()
+
+
+def _ec2(region: str):
+    """Get the ec2 client for the region, created once per process"""
+
+    # boto3.client() on the default session is not thread safe
+    with _EC2_CLIENTS_LOCK:
+        if region not in _EC2_CLIENTS:
+            _EC2_CLIENTS[region] = boto3.client("ec2", region_name=region)
+        return _EC2_CLIENTS[region]
+
+
 def _collect_instances(config: Params):
     """Collect instances, filter by the params"""
 
-    client = boto3.client("ec2", region_name=config.region)
+    client = _ec2(config.region)
     instances = [
         x["Instances"][0]
         for x in client.describe_instances(
@@ -37,10 +53,11 @@ def _get_tag_val(tags: List[Dict], key: str):
     return ""
 
 
-def _get_instance_by_name(name: str, config: Params):
-    """Collect running instances and return instance of a given name or None"""
+def _get_instance_by_name(name: str, config: Params, instances: Optional[List[Dict]] = None):
+    """Return running instance of a given name or None, collect the instances if not given"""
 
-    instances = _collect_instances(config)
+    if instances is None:
+        instances = _collect_instances(config)
     instances_by_name = []
     for instance in instances:
         if _get_tag_val(instance["Tags"], "Name") == name:
@@ -10,6 +10,7 @@ import paramiko
 from paramiko import SSHException
 
 from aws_config import Params
+from ssh_utils import connect_client
 
 # generated by the AWS 'sudo shutdown' and detected by the monitor to download logs
 SHUTDOWN_MESSAGE = "Shutdown scheduled for"
@@ -248,7 +249,10 @@ def upload_and_run(instance, commands: List[List[str]], config: Params, noshutdo
         for attempt in range(20):
             try:
                 print(f"Connecting to {instance_ip}... attempt: {attempt}")
-                client.connect(hostname=instance_ip, username="ubuntu", pkey=key)
+                # the instance might be still booting, be more patient
+                connect_client(
+                    client, instance_ip, key, timeout=15, bastion_host=config.bastion_host
+                )
                 print(f"CONNECTED to {instance_ip}")
                 return True
             # TODO improve exception handling?
@@ -337,7 +341,7 @@ echo 'Before setup..' > /home/ubuntu/setup.log
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
     try:
-        client.connect(hostname=instance_ip, username="ubuntu", pkey=key)
+        connect_client(client, instance_ip, key, bastion_host=config.bastion_host)
         print(f"DONE, connected")
         stdin, stdout, stderr = client.exec_command(script)
     except:
@@ -1,9 +1,12 @@
 import os
+import re
+import socket
 import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Union, List, Optional, Dict, Tuple
+from typing import Union, List, Optional, Dict, Tuple, Iterator
 
 import paramiko
 from paramiko import SSHClient, SSHException
@@ -11,6 +14,79 @@ from paramiko import SSHClient, SSHException
 from aws_config import Params
 from aws_utils import _get_instance_by_name
 from launch import SHUTDOWN_MESSAGE
+from ssh_utils import ShellSession, connect_client
+
+# separates outputs of the individual probes in the batched per-tick command
+_SECTION = b"__SEC__\n"
+# starts each experiment log record, on a new line even if the log ends with \r (tqdm)
+_FILE_HEADER = b"\n__F__"
+
+# one line of the nvidia-smi csv: utilization.gpu, utilization.memory, memory.total,
+# the utilizations might be e.g. [N/A] or [Not Supported] instead of a number
+_GPU_RE = re.compile(
+    rb"^\s*([^,\n]+?)\s*%?\s*,\s*([^,\n]+?)\s*%?\s*,\s*(\d+)\s*MiB", re.MULTILINE
+)
+
+# the Sacred announcement of the EXPID
+_EXPID_ANNOUNCEMENT = b"Started run with ID "
+_EXPID_RE = re.compile(r'Started run with ID "(\d+)"')
+
+# seconds to wait before reconnecting after 1, 2, 3, 4+ failures in a row
+_RETRY_DELAYS = (1, 2, 4, 8)
+
+# SFTP window and packet sizes for the log downloads (paramiko defaults: 2 MiB, 32 KiB)
+_SFTP_WINDOW_SIZE = 2 ** 27
+_SFTP_MAX_PACKET_SIZE = 2 ** 19
+_DOWNLOAD_WORKERS = 4
+
+# CPU load, GPU info and the last lines of each experiment log in one go
+_TICK_COMMAND = "; echo __SEC__; ".join(
+    [
+        "cat /proc/loadavg",
+        "nvidia-smi --query-gpu=utilization.gpu,utilization.memory,memory.total "
+        "--format=csv ",
+        'for f in experiment_*.log; do [ -e "$f" ] || continue; '
+        "printf '\\n__F__%s\\n' \"$f\"; tail -n 2 \"$f\"; done",
+    ]
+)
+
+
+@dataclass
+class GpuStat:
+    """Formatted utilization, memory utilization and total memory (GiB) of one GPU"""
+
+    __slots__ = ("util", "used_mem", "total_mem")
+    util: str
+    used_mem: str
+    total_mem: str
+
+
+@dataclass
+class MonComm:
+    """Latest info about the machine, written by the MachineMonitor, read by the monitor"""
+
+    __slots__ = ("result", "load", "gpu")
+    result: Tuple[List[Tuple[str, str]], str]  # last line per group, heartbeat
+    load: str
+    gpu: List[GpuStat]
+
+
+def _rlines(path: str, chunk: int = 65536) -> Iterator[bytes]:
+    """Yield lines of the file from the last to the first one, reading it backwards by chunks"""
+
+    with open(path, "rb") as fp:
+        position = fp.seek(0, os.SEEK_END)
+        remainder = b""
+        while position > 0:
+            size = min(chunk, position)
+            position -= size
+            fp.seek(position)
+            lines = (fp.read(size) + remainder).split(b"\n")
+            # the first line might continue in the previous chunk
+            remainder = lines[0]
+            for line in reversed(lines[1:]):
+                yield line
+        yield remainder
 
 
 class MachineMonitor(threading.Thread):
@@ -20,22 +96,43 @@ class MachineMonitor(threading.Thread):
         -GPU info
     """
 
-    def __init__(self, name: str, sleep: float, config: Params):
+    def __init__(
+        self, name: str, sleep: float, config: Params, instances: Dict[str, Dict]
+    ):
         threading.Thread.__init__(self)
         self.name = name
         self.daemon = True
-        # python dicts should be thread safe
-        self.comm = {
-            "should_stop": False,
-            "result": ([("?", "Connecting..")], self.now()),
-            "load": "?",
-            "gpu": [{"util": "?", "used_mem": "?", "total_mem": "?"}],
-        }
+        # attribute assignments are atomic, the monitor command only reads them
+        self.comm = MonComm(
+            result=([("?", "Connecting..")], self.now()),
+            load="?",
+            gpu=[GpuStat(util="?", used_mem="?", total_mem="?")],
+        )
         self.sleep = sleep
         self.config = config
+        # name => running instance, replaced by the owner after each EC2 query
+        self.instances = instances
         self.exp_ids: Dict[int:int] = {}  # maps experiment_group_id => Sacred EXPID
         self.is_exp_ids_detected = False
         self.is_final_logs_downloaded = False
+        # not named _stop, that would shadow the threading.Thread._stop
+        self._stop_event = threading.Event()
+        self._client: Optional[SSHClient] = None
+        self._shell: Optional[ShellSession] = None
+
+    def stop(self):
+        """Ask the monitor to end, closing the client unblocks any SSH read in progress"""
+        self._stop_event.set()
+        self._close_shell()
+        client = self._client
+        if client is not None:
+            client.close()
+
+    def _close_shell(self):
+        shell = self._shell
+        self._shell = None
+        if shell is not None:
+            shell.close()
 
     @staticmethod
     def now() -> str:
@@ -44,35 +141,47 @@ class MachineMonitor(threading.Thread):
     def _write(self, result: Union[str, List[Tuple[str, str]]]):
         if isinstance(result, str):
             result = [("??", result)]
-        self.comm[f"result"] = (result, self.now())
+        self.comm.result = (result, self.now())
+
+    @staticmethod
+    def _format_util(value: bytes) -> str:
+        """Percentage for numbers, otherwise as reported by the nvidia-smi (e.g. [N/A])"""
+        text = value.decode("utf-8", "replace")
+        return text + "%" if text.isdigit() else text
 
     @staticmethod
-    def _extract_exp_id(line: str) -> Optional[int]:
+    def _extract_exp_id(raw: bytes) -> Optional[int]:
         """At some point, the Sacred-monitored run says: Started run with ID \"7160\""""
 
-        id_announcement = "Started run with ID "
-        if id_announcement in line:
-            number = line.split(id_announcement)[1].split('"')[1]
-            try:
-                value = int(number)
-                return value
-            except:
-                return None
+        # cheap check first, almost none of the lines contain the announcement
+        if _EXPID_ANNOUNCEMENT not in raw:
+            return None
+        match = _EXPID_RE.search(raw.decode("utf-8", "replace"))
+        return int(match.group(1)) if match is not None else None
 
-    def monitor_exp_id(self, line: str, group_id: int) -> str:
-        """Update EXPID of a current group from the log.
+    def monitor_exp_id(self, tail: bytes, group_id: int) -> str:
+        """Update EXPID of a current group from the last lines of the log.
         Return the current most up-to-date EXPID"""
-        parsed = self._extract_exp_id(line)
+        parsed = self._extract_exp_id(tail)
         if parsed is not None:
             self.exp_ids[group_id] = parsed
         return self.exp_ids[group_id] if group_id in self.exp_ids is not None else "?"
 
     @staticmethod
-    def _download_log(remote_name, local_name, ftp_client):
+    def _download_log(remote_name, local_name, transport: paramiko.Transport):
         if os.path.exists(local_name):
             os.remove(local_name)
         try:
-            ftp_client.get(remote_name, local_name)
+            # own SFTP channel per file, so that the downloads can overlap
+            ftp_client = paramiko.SFTPClient.from_transport(
+                transport,
+                window_size=_SFTP_WINDOW_SIZE,
+                max_packet_size=_SFTP_MAX_PACKET_SIZE,
+            )
+            try:
+                ftp_client.get(remote_name, local_name, prefetch=True)
+            finally:
+                ftp_client.close()
             print(f"Downloaded the: {local_name}")
         except SSHException:
             print(f"SFTP failed")
@@ -81,19 +190,22 @@ class MachineMonitor(threading.Thread):
         """Download all the experiment_{group_id}.log files locally"""
 
         Path(f"remote/logs/{self.name}").mkdir(parents=True, exist_ok=True)
-        ftp_client = client.open_sftp()
+        transport = client.get_transport()
         # print(f"Client open, downloading the logs...")
 
-        remote_name = f"/home/ubuntu/setup.log"
-        local_name = f"remote/logs/{self.name}/setup.log"
-        self._download_log(remote_name, local_name, ftp_client)
-
+        names = [("/home/ubuntu/setup.log", f"remote/logs/{self.name}/setup.log")]
         for group_id in group_ids:
             remote_name = f"/home/ubuntu/experiment_{group_id}.log"
             local_name = f"remote/logs/{self.name}/experiment_{group_id}.log"
-            self._download_log(remote_name, local_name, ftp_client)
+            names.append((remote_name, local_name))
 
-        ftp_client.close()
+        with ThreadPoolExecutor(max_workers=_DOWNLOAD_WORKERS) as executor:
+            futures = [
+                executor.submit(self._download_log, remote_name, local_name, transport)
+                for remote_name, local_name in names
+            ]
+            for future in futures:
+                future.result()
 
     def download_logs_before_shutdown(
         self, group_ids: List[int], group_zero_line: str, client: SSHClient
@@ -120,16 +232,12 @@ class MachineMonitor(threading.Thread):
             local_name = f"remote/logs/{self.name}/experiment_{group_id}.log"
 
             try:
-                fp = open(local_name)
-                lines = fp.readlines()
-                for line in reversed(lines):
+                for line in _rlines(local_name):
                     expid = self._extract_exp_id(line)
                     if expid is not None:
                         # print(f'DETECTED for {group_id} EXPID={expid} ')
                         self.exp_ids[group_id] = expid
-                        fp.close()
                         break
-                fp.close()
             except:
                 continue
 
@@ -139,16 +247,30 @@ class MachineMonitor(threading.Thread):
 
         It handles the tqdm's newlines, carriage returns, arrows.. in the string.
         """
-        # split by carriage returns (moves cursor back to update the progress bar)
-        last_line = stdout_result.decode("utf-8").split("\r")[-1].strip()
+        # after the last carriage return (moves cursor back to update the progress bar)
+        last_line = stdout_result.rsplit(b"\r", 1)[-1].strip()
         # extract the last line
-        last_line = last_line.split("\n")[-1]
+        last_line = last_line.rsplit(b"\n", 1)[-1]
         # remove the up arrow used by the validation
-        last_line = last_line.replace("\x1b[A", "")
-        return last_line
+        last_line = last_line.replace(b"\x1b[A", b"")
+        return last_line.decode("utf-8", "replace")
+
+    @staticmethod
+    def _split_tails(tails_out: bytes) -> Dict[int, bytes]:
+        """Split the output of the batched tail loop into group_id => last lines"""
+        tails = {}
+        for record in tails_out.split(_FILE_HEADER)[1:]:
+            # record is: experiment_{group_id}.log\n{tail}
+            filename, _, tail = record.partition(b"\n")
+            group_id = filename[len(b"experiment_"): -len(b".log")]
+            if group_id.isdigit():
+                tails[int(group_id)] = tail
+        return tails
 
     def run(self):
-        instance = _get_instance_by_name(self.name, self.config)
+        instance = _get_instance_by_name(
+            self.name, self.config, instances=list(self.instances.values())
+        )
         if instance is None:
             self._write(f"ERROR: could not find the instance")
             return
@@ -159,60 +281,68 @@ class MachineMonitor(threading.Thread):
         key = paramiko.RSAKey.from_private_key_file(self.config.pem_file)
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self._client = client
 
-        while not self.comm["should_stop"]:
+        failures = 0
+        while not self._stop_event.is_set():
 
-            if _get_instance_by_name(self.name, self.config) is None:
+            if self.name not in self.instances:
                 self._write(f"My instance terminated, exiting!")
                 return
 
+            if failures > 0:
+                # back off, so that an unreachable machine is not re-dialed in a loop
+                delay = _RETRY_DELAYS[min(failures, len(_RETRY_DELAYS)) - 1]
+                if self._stop_event.wait(delay):
+                    break
+
+            # the session of the previous (lost) connection
+            self._close_shell()
+            try:
+                connect_client(
+                    client, instance_ip, key, bastion_host=self.config.bastion_host
+                )
+            except (SSHException, socket.error):
+                self._write(f"Could not connect!")
+                failures += 1
+                continue
+
             try:
-                client.connect(hostname=instance_ip, username="ubuntu", pkey=key)
                 # self.write(f'DONE, connected to {self.name} with IP: {instance_ip}')
                 self._write(f"DONE, connected!")
+                shell = ShellSession(client)
+                self._shell = shell
 
-                while not self.comm["should_stop"]:
+                while not self._stop_event.is_set():
 
-                    if _get_instance_by_name(self.name, self.config) is None:
+                    if self.name not in self.instances:
                         self._write(f"My instance terminated, exiting!")
                         return
 
+                    # read everything in one batched command (same SSH channel each tick)
+                    tick_out = shell.run(_TICK_COMMAND)
+                    load_out, gpu_out, tails_out = tick_out.split(_SECTION, 2)
+
                     # read the CPU load
-                    stdin, stdout, stderr = client.exec_command(f"cat /proc/loadavg")
-                    last_min_load = stdout.read().decode("utf-8").split(" ")[0].strip()
-                    self.comm["load"] = last_min_load
+                    last_min_load = load_out.decode("utf-8").split(" ")[0].strip()
+                    self.comm.load = last_min_load
 
                     # read the GPU utilization, memory, total memory and format it
-                    stdin, stdout, stderr = client.exec_command(
-                        "nvidia-smi --query-gpu=utilization.gpu,utilization.memory,memory.total "
-                        "--format=csv "
-                    )
-                    line_per_gpu = stdout.read().decode("utf-8").split("\n")[1:]
                     # expected format is: 2 %, 2 %, 11178 MiB
                     result_per_gpu = []
-                    for line in line_per_gpu:
-                        values = line.split(",")
-                        if len(values) == 1:
-                            continue
-                        res = {
-                            "util": values[0].replace(" ", ""),
-                            "used_mem": values[1].replace(" ", ""),
-                            "total_mem": str(
-                                int(round(float(values[2].split(" ")[1]) / 1024, 0))
-                            ),
-                        }
+                    for match in _GPU_RE.finditer(gpu_out):
+                        util, used_mem, total_mib = match.groups()
+                        res = GpuStat(
+                            util=self._format_util(util),
+                            used_mem=self._format_util(used_mem),
+                            total_mem=str((int(total_mib) + 512) // 1024),
+                        )
                         result_per_gpu.append(res)
-                    self.comm["gpu"] = result_per_gpu
-
-                    # get experiment_{group_id}.log files:
-                    stdin, stdout, stderr = client.exec_command(f"ls experiment_*.log")
-                    files = stdout.read().decode("utf-8").split("\n")
-                    file_ids = []
-                    for file in files:
-                        if len(file) > 0:
-                            f = file.split("_")[1].split(".log")[0]
-                            file_ids.append(int(f))
-                    file_ids = sorted(file_ids)
+                    self.comm.gpu = result_per_gpu
+
+                    # get the experiment_{group_id}.log files and their last lines
+                    tails = self._split_tails(tails_out)
+                    file_ids = sorted(tails)
 
                     # detect the EXPID during setup (might have been announced before in the log)
                     if not self.is_exp_ids_detected:
@@ -222,13 +352,9 @@ class MachineMonitor(threading.Thread):
                     # read the last line per experiment group
                     results = []
                     for group_id in file_ids:
-                        filename = f"/home/ubuntu/experiment_{group_id}.log"
-                        stdin, stdout, stderr = client.exec_command(
-                            f"tail -n 2 {filename}"
-                        )
-                        last_line = self.extract_last_line(stdout.read())
+                        last_line = self.extract_last_line(tails[group_id])
                         id = self.monitor_exp_id(
-                            last_line, group_id
+                            tails[group_id], group_id
                         )  # update the EXPID
                         results.append((id, last_line))
 
@@ -239,10 +365,11 @@ class MachineMonitor(threading.Thread):
 
                     # write all lines including the heartbeat
                     self._write(results)
-                    time.sleep(self.sleep)
+                    failures = 0
+                    self._stop_event.wait(self.sleep)
 
-            # except SSHException or NoValidConnectionsError:
             except:
                 self._write(f"Could not connect!")
+                failures += 1
 
         print(f"\t{self.name} - monitor: exiting, bye")
@@ -0,0 +1,133 @@
+import re
+import socket
+import threading
+from typing import Optional
+
+import paramiko
+from paramiko import SSHClient, SSHException, PKey, Transport
+
+SSH_PORT = 22
+# large kernel buffers and no Nagle, the traffic is mostly small request/response pairs
+_SOCKET_BUFFER_SIZE = 32 << 20
+# fail fast on unreachable machines, the callers retry
+CONNECT_TIMEOUT = 3
+
+# SSH connection to the bastion (jump host), shared by all the connections in the process
+_bastion: Optional[SSHClient] = None
+_bastion_lock = threading.Lock()
+
+# printed after each command, the exit code is captured between the underscores
+_SENTINEL = "__DONE__"
+_SENTINEL_RE = re.compile(rb"__DONE__(\d+)__\n")
+
+
+class ShellSession:
+    """ One long-running shell channel reused for all the commands,
+    instead of opening a new channel (1-2 round trips) per exec_command.
+
+    No pty is requested, so the shell does not echo the input, print prompts
+    or translate newlines; the end of each output is framed by a sentinel.
+    """
+
+    def __init__(self, client: SSHClient):
+        self.channel = client.get_transport().open_session()
+        self.channel.invoke_shell()
+        self._buffer = b""
+        # drop the stderr and whatever the login scripts printed
+        self.run("exec 2>/dev/null")
+
+    def run(self, command: str) -> bytes:
+        """Run the command in the shell, return its stdout"""
+
+        self.channel.sendall(f"{command}\necho {_SENTINEL}$?__\n".encode("utf-8"))
+        while True:
+            match = _SENTINEL_RE.search(self._buffer)
+            if match is not None:
+                result = self._buffer[: match.start()]
+                self._buffer = self._buffer[match.end():]
+                return result
+            data = self.channel.recv(32768)
+            if len(data) == 0:
+                raise SSHException("The shell channel was closed")
+            self._buffer += data
+
+    def close(self):
+        self.channel.close()
+
+
+def _make_socket(hostname: str, timeout: float) -> socket.socket:
+    """Open a TCP connection to the SSH port with TCP_NODELAY and large send/recv buffers"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((hostname, SSH_PORT))
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def _connect(client: SSHClient, hostname: str, username: str, key: PKey, sock, timeout: float):
+    client.connect(
+        hostname=hostname,
+        username=username,
+        pkey=key,
+        sock=sock,
+        timeout=timeout,
+        banner_timeout=timeout,
+        auth_timeout=timeout,
+        # only the pem key is used, do not probe the agent and ~/.ssh keys
+        allow_agent=False,
+        look_for_keys=False,
+    )
+
+
+def _bastion_transport(bastion_host: str, key: PKey, timeout: float) -> Transport:
+    """Get the transport to the bastion, connect (or reconnect) if needed.
+
+    The bastion_host is in the form [user@]host, user defaults to ubuntu.
+    """
+    global _bastion
+
+    with _bastion_lock:
+        transport = _bastion.get_transport() if _bastion is not None else None
+        if transport is None or not transport.is_active():
+            if _bastion is not None:
+                _bastion.close()
+            username, _, hostname = bastion_host.rpartition("@")
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            _connect(
+                client,
+                hostname,
+                username or "ubuntu",
+                key,
+                _make_socket(hostname, timeout),
+                timeout,
+            )
+            _bastion = client
+            transport = client.get_transport()
+        return transport
+
+
+def connect_client(
+    client: SSHClient,
+    hostname: str,
+    key: PKey,
+    timeout: float = CONNECT_TIMEOUT,
+    bastion_host: str = "",
+):
+    """Connect the client to the instance (as ubuntu) over the tuned socket,
+    or through a channel of the shared bastion transport if the bastion_host is set"""
+
+    if bastion_host:
+        sock = _bastion_transport(bastion_host, key, timeout).open_channel(
+            "direct-tcpip", (hostname, SSH_PORT), ("", 0), timeout=timeout
+        )
+    else:
+        sock = _make_socket(hostname, timeout)
+    _connect(client, hostname, "ubuntu", key, sock, timeout)